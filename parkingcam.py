@@ -1,11 +1,18 @@
 import os
 import sys
+# Pull RTSP over TCP: lost UDP packets show up as corrupted frames. Don't buffer input or delay
+# decoding, only the latest frame is of interest (can be overridden from the environment)
+os.environ.setdefault('OPENCV_FFMPEG_CAPTURE_OPTIONS', 'rtsp_transport;tcp|fflags;nobuffer|flags;low_delay')
 import cv2
 import time
+import queue
 import random
 import logging
 import platform
 import argparse
+import functools
+import collections
+import threading
 import subprocess
 import numpy as np
 from datetime import datetime, time as dtime
@@ -73,6 +80,30 @@ if not is_windows:
     sys.path.append("..")
     from lib import LCD_1inch69
 
+# Latest DHT22 reading as a (temperature, humidity, time) tuple, replaced as a whole by the
+# sensor thread and read by the display
+sensor_reading = None
+sensor_lock = threading.Lock()
+sensor_interval = 2  # The DHT22 can't be read more often than every 2 seconds
+sensor_max_age = 10  # Don't display readings older than this (in seconds)
+
+# Function to poll the DHT sensor in the background, so slow or failed reads don't block the display
+def sensor_poll_loop():
+    global sensor_reading
+    while True:
+        try:
+            temp = sensor.temperature
+            humi = sensor.humidity
+        except RuntimeError:
+            log.warning('DHT reading failed')
+        except Exception:
+            # Keep polling on other (GPIO) errors, otherwise the readings would stop for good
+            log.exception('DHT reading failed')
+        else:
+            with sensor_lock:
+                sensor_reading = (temp, humi, time.time())
+        time.sleep(sensor_interval)
+
 def display_init():
     try:
         log.debug('Start display initialization')
@@ -98,100 +129,179 @@ def display_init():
 
     return disp
 
-def display_draw_status(disp, car_history, car_image):
-    font = ImageFont.truetype("assets/RobotoMonoMedium.ttf", 64)
-    font_sm = ImageFont.truetype("assets/RobotoMonoMedium.ttf", 32)
-    canvas = Image.new("RGB", (disp.width,disp.height), (255, 0, 255))
-    width, height = car_image.size
+# Display canvas, kept between frames. The background is only filled once; every frame
+# overwrites the camera image and the status bar entries
+display_canvas = None
+# PIL image the canvas is copied into for text rendering, also kept between frames
+display_image = None
+# Everything visible in the last frame sent to the display, and the hash of its camera image
+# and the detector run its boxes come from
+display_state = None
+display_frame_hash = None
+display_detection_count = None
+
+def display_draw_status(disp, car_history, car_image, frame_hash, detection_count):
+    global display_canvas, display_image, display_state, display_frame_hash, display_detection_count
+    if display_canvas is None:
+        display_canvas = np.full((disp.height, disp.width, 3), (255, 0, 255), dtype=np.uint8)
+        display_image = Image.new("RGB", (disp.width, disp.height))
+    canvas = display_canvas
     size=(240, 240)
-    
-    # Determine if the image is portrait or landscape
-    if height > width:  # Portrait
-        # Crop a square from the bottom
-        new_height = width
-        left = 0
-        top = height - width  # Bottom crop
-        right = width
-        bottom = height
-    else:  # Landscape or square
-        # Crop a square from the center
-        new_width = height
-        left = (width - height) // 2  # Center crop
-        top = 0
-        right = left + height
-        bottom = height
 
     # Crop the image
-    car_image = car_image.crop((left, top, right, bottom))
-    # Resize the cropped image to 240x240
-    car_image = car_image.resize(size)
+    top, bottom, left, right, interpolation = display_crop(*car_image.shape[:2], size)
+    car_image = car_image[top:bottom, left:right]
+
+    # Collect the time-varying texts before drawing anything
+    statustext_time = None
+    if args.clock:
+        now = time.localtime()
+        separator = ':' if now.tm_sec % 2 else ' '  # Blinking colon
+        statustext_time = f'{now.tm_hour:02d}{separator}{now.tm_min:02d}'
+
+    temp = humi = None
+    if args.sensor:
+        with sensor_lock:
+            reading = sensor_reading
+        if reading is not None and time.time() - reading[2] <= sensor_max_age:
+            temp, humi, _ = reading
+        else:
+            log.debug('No recent DHT reading')
+
+    # Skip the redraw and the SPI transfer if nothing visible has changed since the last refresh.
+    # The camera image counts as unchanged if its hash differs in only a few bits (sensor noise)
+    # and the detector hasn't run since, which could have changed the boxes drawn on it
+    state = (statustext_time, temp, humi, tuple(car_history))
+    frame_unchanged = (display_frame_hash is not None
+                       and detection_count == display_detection_count
+                       and (frame_hash ^ display_frame_hash).bit_count() <= frame_hash_tolerance)
+    if state == display_state and frame_unchanged:
+        log.debug('Display content unchanged')
+        return
+    display_state = state
+
+    # The canvas still holds the camera image of the last refresh, only replace it if it changed
+    if not frame_unchanged:
+        display_frame_hash = frame_hash
+        display_detection_count = detection_count
+
+        # Resize the cropped image to 240x240 straight into the canvas below the statusbar,
+        # then convert it from OpenCV's BGR to the RGB of the canvas in place
+        camera = canvas[40:280, 0:240]
+        cv2.resize(car_image, size, dst=camera, interpolation=interpolation)
+        cv2.cvtColor(camera, cv2.COLOR_BGR2RGB, dst=camera)
 
     # Statusbar size = 240x40
     # Statusbar entry size = 24x40
-    canvas.paste(car_image, (0, 40))
 
-    draw = ImageDraw.Draw(canvas)
-    for i, car_present in enumerate(car_history):
-        if car_present:
-            draw.rectangle([(i*2, 0), ((i+1)*2, 40)], fill = "GREEN")
-        else:
-            draw.rectangle([(i*2, 0), ((i+1)*2, 40)], fill = "RED")
+    render_statusbar(car_history, canvas[0:40, 0:len(car_history)*2])
 
-    if args.clock:
-        if int(time.time()) % 2:
-            statustext_time = datetime.now().strftime('%H:%M')
-        else:
-            statustext_time = datetime.now().strftime('%H %M')
+    # Text is rendered by PIL
+    display_image.frombytes(canvas)
+    canvas = display_image
+
+    if statustext_time is not None:
         draw_text_with_background(
             img=canvas,
             text=statustext_time,
-            font=font,
+            font=clock_font,
             position=(120, 45),  # Position of the text (center of the text will be at (250, 250))
             alignment='center',  # Alignment options: 'center', 'left', 'right'
             text_color='white',  # Color of the text
             bg_color=(127, 0, 127)  # Background color 
         )
 
-    if args.sensor:
-        try:
-            temp = sensor.temperature
-            humi = sensor.humidity
-        except RuntimeError:
-            log.warning('DHT reading failed')
-        else: 
-            temp_color = interpolate_color(temp,16,22,28)
-            draw_text_with_background(
-                img=canvas,
-                text=f"{temp:0.1f}ºC",
-                font=font_sm,
-                position=(5, 120),
-                alignment='left',
-                text_color='black',
-                bg_color=temp_color
-            )
-
-            humi_color = interpolate_color(humi,25,50,75)
-            draw_text_with_background(
-                img=canvas,
-                text=f"{humi:0.1f}%",
-                font=font_sm,
-                position=(240, 120),
-                alignment='right',
-                text_color='black',
-                bg_color=humi_color
-            )
+    if temp is not None:
+        temp_color = temp_color_scale(temp)
+        draw_text_with_background(
+            img=canvas,
+            text=f"{temp:0.1f}ºC",
+            font=sensor_font,
+            position=(5, 120),
+            alignment='left',
+            text_color='black',
+            bg_color=temp_color
+        )
+
+        humi_color = humi_color_scale(humi)
+        draw_text_with_background(
+            img=canvas,
+            text=f"{humi:0.1f}%",
+            font=sensor_font,
+            position=(240, 120),
+            alignment='right',
+            text_color='black',
+            bg_color=humi_color
+        )
 
     disp.ShowImage(canvas)
 
-def draw_text_with_background(img, text, font, position, alignment='center', text_color='black', bg_color='yellow'):
-    draw = ImageDraw.Draw(img)
+# Function to compute the square crop of the camera image and the interpolation to resize it to
+# the display size with. The image size doesn't change, so this is only computed once
+@functools.lru_cache(maxsize=4)
+def display_crop(height, width, size):
+    # Determine if the image is portrait or landscape
+    if height > width:  # Portrait
+        # Crop a square from the bottom
+        left = 0
+        top = height - width  # Bottom crop
+        right = width
+        bottom = height
+    else:  # Landscape or square
+        # Crop a square from the center
+        left = (width - height) // 2  # Center crop
+        top = 0
+        right = left + height
+        bottom = height
+
+    # Downscales use area (box) interpolation, which averages all source pixels and so doesn't
+    # alias fine detail into moiré like linear interpolation does
+    side = bottom - top
+    if side > size[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return top, bottom, left, right, interpolation
+
+# Function to render the detection history into the status bar area, 2px wide per entry
+def render_statusbar(car_history, statusbar):
+    car_mask = np.repeat(np.asarray(car_history, dtype=bool), 2)
+    statusbar[:, car_mask] = (0, 128, 0)  # Green
+    statusbar[:, ~car_mask] = (255, 0, 0)  # Red
+
+# Rendered text panels, keyed by text, font and colors (the clock only changes once per second)
+_panel_cache = {}
+_panel_cache_size = 8
+text_padding = 10  # Padding around the text
+
+# Function to render text on a padded background into a small image, reusing earlier renders
+def render_text_panel(text, font, text_color, bg_color):
+    key = (text, font.path, font.size, text_color, bg_color)
+    panel = _panel_cache.get(key)
+    if panel is not None:
+        return panel
 
     # Get the size of the text (bounding box)
-    text_bbox = draw.textbbox((0, 0), text, font=font)
+    text_bbox = font.getbbox(text)
     text_width = text_bbox[2] - text_bbox[0]
     text_height = text_bbox[3] - text_bbox[1]
 
+    # Fill the panel with the background color and draw the text on top of it
+    panel = Image.new("RGB", (text_width + text_padding*2 + 1, text_height + text_padding*2 + 1), bg_color)
+    ImageDraw.Draw(panel).text((text_padding, 0), text, font=font, fill=text_color)
+
+    # Keep only the most recent panels
+    if len(_panel_cache) >= _panel_cache_size:
+        _panel_cache.pop(next(iter(_panel_cache)))
+    _panel_cache[key] = panel
+
+    return panel
+
+def draw_text_with_background(img, text, font, position, alignment='center', text_color='black', bg_color='yellow'):
+    panel = render_text_panel(text, font, text_color, bg_color)
+
     # Calculate the position based on the alignment
+    text_width = panel.width - text_padding*2 - 1
     x, y = position
 
     if alignment == 'center':
@@ -200,18 +310,25 @@ def draw_text_with_background(img, text, font, position, alignment='center', tex
         x -= text_width
     # If alignment is 'left', we don't need to adjust x
 
-    # Draw a rectangle behind the text (background)
-    padding = 10  # Padding around the text
-    draw.rectangle(
-        [x - padding, y, x + text_width + padding, y + text_height + padding*2],
-        fill=bg_color
-    )
-
-    # Draw the text on top of the rectangle
-    draw.text((x, y), text, font=font, fill=text_color)
+    # Paste the pre-rendered text with its background
+    img.paste(panel, (x - text_padding, y))
 
     return img
 
+# Function to precompute the colors of a scale for every 0.1 step between min and max value,
+# as readings are displayed with one decimal. Returns a lookup function for a reading
+def color_scale(min_value, ideal_value, max_value):
+    offset = round(min_value * 10)
+    colors = [interpolate_color(i / 10, min_value, ideal_value, max_value)
+              for i in range(offset, round(max_value * 10) + 1)]
+
+    def lookup(curr_value):
+        # Readings outside the scale get the color of its ends (red)
+        index = min(max(round(curr_value * 10) - offset, 0), len(colors) - 1)
+        return colors[index]
+
+    return lookup
+
 def interpolate_color(curr_value, min_value, ideal_value, max_value):
     # Define RGB values for red, yellow, and green
     red = (255, 0, 0)
@@ -240,6 +357,33 @@ def interpolate_color(curr_value, min_value, ideal_value, max_value):
             int(green[2] + ratio * (red[2] - green[2]))   # Interpolate B
         )
 
+# Color scales of the temperature (ideal 22ºC) and humidity (ideal 50%) readings
+temp_color_scale = color_scale(16, 22, 28)
+humi_color_scale = color_scale(25, 50, 75)
+
+# Frames waiting for the display thread. It only holds the latest frame: when the display falls
+# behind, the older frame is replaced instead of delaying the recognition loop
+display_queue = queue.Queue(maxsize=1)
+
+# Function to hand a frame to the display thread, replacing any frame it hasn't picked up yet
+def display_submit(car_history, car_image, frame_hash, detection_count):
+    try:
+        display_queue.get_nowait()
+        log.debug('Display is behind, dropping a frame')
+    except queue.Empty:
+        pass
+    display_queue.put_nowait((car_history, car_image, frame_hash, detection_count))
+
+# Function to draw submitted frames on the SPI display, running in its own thread
+def display_worker(disp):
+    while True:
+        car_history, car_image, frame_hash, detection_count = display_queue.get()
+        # Keep the thread alive on errors, otherwise the display would freeze for good
+        try:
+            display_draw_status(disp, car_history, car_image, frame_hash, detection_count)
+        except Exception:
+            log.exception('Display update failed')
+
 def display_exit(disp):
     disp.module_exit()
 
@@ -249,82 +393,153 @@ def display_exit(disp):
 
 # Function to log car activity (arrival and departure)
 def log_car_activity(timestamp, action):
-    log_entry=f'{timestamp} :: {action}'
+    log_entry=f'{timestamp:%Y-%m-%d %H:%M:%S} :: {action}'
     log.info(log_entry)
     with open('car.log', 'a') as log_file:
         log_file.write(f'{log_entry}\n')
 
-def draw_statusbar(car_history, debug_image):
+# Debug images waiting to be saved. Saving runs in its own thread so slow storage (SD card)
+# doesn't delay the recognition loop; when it falls behind, the oldest image is dropped
+debug_image_queue = queue.Queue(maxsize=4)
+
+# Function to hand a debug image to the saving thread
+def debug_image_submit(debug_image, debug_image_path):
+    if debug_image_queue.full():
+        try:
+            debug_image_queue.get_nowait()
+            log.warning('Saving debug images is behind, dropping one')
+        except queue.Empty:
+            pass
+    debug_image_queue.put_nowait((debug_image, debug_image_path))
+
+# Function to save submitted debug images, running in its own thread
+def debug_image_worker():
+    while True:
+        debug_image, debug_image_path = debug_image_queue.get()
+        if cv2.imwrite(debug_image_path, debug_image):
+            log.debug(f"Debug image saved: {debug_image_path}")
+        else:
+            log.warning(f"Couldn't save debug image: {debug_image_path}")
+
+# Marks of the text status bar for a recognition without and with a car
+status_marks = ('❌ ', '✔️ ')
+
+def draw_statusbar(car_history, debug_image, frame_hash, detection_count):
     
     if not is_windows:
-        display_draw_status(display, car_history, debug_image)
+        display_submit(list(car_history), debug_image, frame_hash, detection_count)
 
-    statusbar = ''
-    for i, car_present in enumerate(car_history):
-        statusbar = f'{statusbar}✔️ ' if car_present else f'{statusbar}❌ '
-    log.debug(statusbar)
+    # Only build the text status bar when it is actually logged
+    if log.isEnabledFor(logging.DEBUG):
+        statusbar = ''.join([status_marks[car_present] for car_present in car_history])
+        log.debug(statusbar)
 
     return None
 
+# Class names of the MobileNet-SSD model and the box colors of the trigger classes (BGR, like the frames)
+class_names = {0:'background', 1:'aeroplane', 2: 'bicycle', 3: 'bird', 4: 'boat',
+                5: 'bottle', 6: 'bus', 7: 'car', 8: 'cat', 9: 'chair', 10: 'cow', 
+                11: 'diningtable', 12: 'dog', 13: 'horse', 14: 'motorbike', 15: 'person', 
+                16: 'pottedplant', 17: 'sheep', 18: 'sofa', 19: 'train', 20: 'tvmonitor'}
+class_colors = {4: (0, 255, 0), 7: (0, 0, 255), 9: (255, 0, 255), 15: (0, 255, 255), 20: (255, 255, 0)}
+
 # Function to save an image with bounding boxes and class_id in debug mode
 def draw_debug_image(roi, detections):
-
-    # Initiate font for debug image output
-    font_size = 24
-    font = ImageFont.truetype("assets/RobotoMonoMedium.ttf", font_size)
-
-    class_names = {0:'background', 1:'aeroplane', 2: 'bicycle', 3: 'bird', 4: 'boat',
-                    5: 'bottle', 6: 'bus', 7: 'car', 8: 'cat', 9: 'chair', 10: 'cow', 
-                    11: 'diningtable', 12: 'dog', 13: 'horse', 14: 'motorbike', 15: 'person', 
-                    16: 'pottedplant', 17: 'sheep', 18: 'sofa', 19: 'train', 20: 'tvmonitor'}
-    class_colors = {4: (0, 255, 0), 7: (255, 0, 0), 9: (255, 0, 255), 15: (255, 255, 0), 20: (0, 255, 255)}
     outlinecolor = (0, 0, 0) # Black outline
-    image_pil = Image.fromarray(roi)
-
-    # Loop over all detections and draw the bounding boxes
-    for i in range(detections.shape[2]):
-        confidence = detections[0, 0, i, 2]
-        if confidence > 0.4:  # Confidence threshold for detection
-            class_id = int(detections[0, 0, i, 1])
-
-            class_name = class_names.get(class_id, f"Class {class_id}")
-            label = f"{class_name}: {confidence:.2f}"
-
-            class_color = class_colors.get(class_id,(127, 127, 127)) # Gray for undefined
-
-            # Draw bounding box
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-            cv2.rectangle(roi, (startX, startY), (endX, endY), class_color, 2)
-
-            # Convert OpenCV image to PIL image
-            image_pil = Image.fromarray(roi)
-            draw = ImageDraw.Draw(image_pil)
-
-            Δ = 2
-            startY = startY-font_size-Δ
-            # Draw the text outline
-            draw.text((startX-Δ, startY-Δ), label, font=font, fill=outlinecolor)
-            draw.text((startX+Δ, startY-Δ), label, font=font, fill=outlinecolor)
-            draw.text((startX-Δ, startY+Δ), label, font=font, fill=outlinecolor)
-            draw.text((startX+Δ, startY+Δ), label, font=font, fill=outlinecolor)
-            # Draw the text over it
-            draw.text((startX, startY), label, font=font, fill=class_color)
-            
-            # Convert PIL image back to OpenCV image
-            # roi = np.array(image_pil)  
-
-    return image_pil
+
+    # Extract confidences, class ids and pixel bounding boxes of all detections at once
+    confidences = detections[:, 2].tolist()
+    class_ids = detections[:, 1].astype(int).tolist()
+    roi_h, roi_w = roi.shape[:2]
+    boxes = (detections[:, 3:7] * np.array([roi_w, roi_h, roi_w, roi_h])).astype(int).tolist()
+
+    # Loop over the detections and draw the bounding boxes
+    for confidence, class_id, box in zip(confidences, class_ids, boxes):
+        class_name = class_names.get(class_id, f"Class {class_id}")
+        label = f"{class_name}: {confidence:.2f}"
+
+        class_color = class_colors.get(class_id,(127, 127, 127)) # Gray for undefined
+
+        # Draw bounding box
+        (startX, startY, endX, endY) = box
+        cv2.rectangle(roi, (startX, startY), (endX, endY), class_color, 2)
+
+        # Draw the label above the box: the outline first, then the text over it
+        Δ = 2
+        origin = (startX, startY-Δ*2)  # Bottom-left corner of the text
+        cv2.putText(roi, label, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.8, outlinecolor, 2+Δ*2, cv2.LINE_AA)
+        cv2.putText(roi, label, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.8, class_color, 2, cv2.LINE_AA)
+
+    return roi
+
+# Maximum number of differing hash bits for two frames to be considered the same
+frame_hash_tolerance = 4
+frame_hash_small = np.empty((8, 9), np.uint8)
+
+# Function to compute a 64-bit difference hash (dHash) of a grayscale frame: each bit tells
+# whether a pixel of the 9x8 thumbnail is brighter than its left neighbour
+def compute_frame_hash(gray):
+    small = cv2.resize(gray, (9, 8), dst=frame_hash_small, interpolation=cv2.INTER_AREA)
+    diff = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(diff).tobytes(), 'big')
+
+# Class to keep the stream drained in the background: it grabs every frame as it arrives, but
+# only retrieves (converts to BGR) the ones that are read, so read() always returns the latest frame
+class LatestFrameReader:
+    def __init__(self, cap):
+        self.cap = cap
+        self.running = True
+        self.frame_requested = threading.Event()
+        self.frame_ready = threading.Event()
+        self.result = (False, None)
+        # All VideoCapture calls happen in this thread
+        self.thread = threading.Thread(target=self.grab_loop, daemon=True)
+        self.thread.start()
+
+    def grab_loop(self):
+        while self.running:
+            ret = self.cap.grab()
+            if self.frame_requested.is_set():
+                self.result = self.cap.retrieve() if ret else (False, None)
+                self.frame_requested.clear()
+                self.frame_ready.set()
+            if not ret:
+                break
+        self.running = False
+        self.cap.release()
+
+    def read(self, timeout=5):
+        if not self.running:
+            return False, None
+        self.frame_ready.clear()
+        self.frame_requested.set()
+        if not self.frame_ready.wait(timeout):
+            return False, None
+        return self.result
+
+    def release(self):
+        self.running = False
+
+# Timeout for opening and reading the RTSP stream (in milliseconds)
+rtsp_timeout_ms = 5000
 
 # Function to connect/reconnect to the RTSP stream
 def connect_to_rtsp_stream(rtsp_url):
-    cap = cv2.VideoCapture(rtsp_url)
+    if args.hwdecode:
+        # Decode H.264 on the V4L2 hardware decoder (needs OpenCV built with GStreamer)
+        pipeline = (f'rtspsrc location="{rtsp_url}" latency=100 ! rtph264depay ! h264parse ! v4l2h264dec'
+                    ' ! videoconvert ! video/x-raw,format=BGR ! appsink max-buffers=1 drop=true')
+        cap = cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
+    else:
+        # Give up on a dead stream after a few seconds instead of FFmpeg's default 30
+        cap = cv2.VideoCapture(rtsp_url, cv2.CAP_FFMPEG, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, rtsp_timeout_ms,
+                                                          cv2.CAP_PROP_READ_TIMEOUT_MSEC, rtsp_timeout_ms])
     if not cap.isOpened():
         log.error(f"Failed to connect to {rtsp_url}")
         return None
     else:
         log.info(f"Successfully connected to {rtsp_url}")
-    return cap
+    return LatestFrameReader(cap)
 
 ####################################################################################################
 ####################################################################################################
@@ -337,6 +552,7 @@ parser.add_argument("--image", action="store_true", help="Enable debug image out
 parser.add_argument("--notray", action="store_true", help="Disable Windows tray icon.")
 parser.add_argument("--clock",action="store_true", help="Display clock on the SPI Display")
 parser.add_argument("--sensor",action="store_true", help="Display DHT22 readings on the SPI Display")
+parser.add_argument("--hwdecode", action="store_true", help="Decode the RTSP stream on the V4L2 hardware decoder via GStreamer.")
 
 args = parser.parse_args()
 
@@ -351,16 +567,43 @@ else:
         format='%(levelname)s: %(message)s'
     )
 log = logging.getLogger(__name__)
+# Log the versions of the image libraries, handy when comparing installations
+log.debug(f"OpenCV {cv2.__version__}, Pillow {Image.__version__}, NumPy {np.__version__}")
+
+# Load the fonts once: clock and DHT readings on the SPI display
+font_path = "assets/RobotoMonoMedium.ttf"
+clock_font = ImageFont.truetype(font_path, 64)
+sensor_font = ImageFont.truetype(font_path, 32)
 
 # Initialize system tray icon
 if is_windows:
     icon = icon_init()
 else:
     display = display_init()
+    threading.Thread(target=display_worker, args=(display,), daemon=True).start()
     sensor = adafruit_dht.DHT22(board.D4)
+    if args.sensor:
+        threading.Thread(target=sensor_poll_loop, daemon=True).start()
+
+if args.image:
+    threading.Thread(target=debug_image_worker, daemon=True).start()
 
 # Load pre-trained object detection model (https://github.com/chuanqi305/MobileNet-SSD)
 net = cv2.dnn.readNetFromCaffe('assets/deploy.prototxt', 'assets/mobilenet_iter_73000.caffemodel')
+# Run it on the GPU in half precision if OpenCV was built with CUDA and there is a device,
+# otherwise on an OpenCL device (OpenCV falls back to FP32 or the CPU if it can't do FP16)
+if cv2.cuda.getCudaEnabledDeviceCount() > 0:
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA_FP16)
+    log.info("Running object detection on CUDA")
+elif cv2.ocl.haveOpenCL():
+    net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+    net.setPreferableTarget(cv2.dnn.DNN_TARGET_OPENCL_FP16)
+    log.info("Running object detection on OpenCL")
+# Run the detector once on a blank input: the first forward pass sets up the layers (and compiles
+# the GPU kernels), which would otherwise delay the first recognition
+net.setInput(cv2.dnn.blobFromImage(np.zeros((300, 300, 3), dtype=np.uint8), 0.007843, (300, 300), 127.5))
+net.forward()
 
 # Load environment variables from .env file
 load_dotenv()
@@ -379,14 +622,48 @@ cap = connect_to_rtsp_stream(rtsp_url)
 # Interval to run the recognition (in seconds)
 recognition_interval = 1
 
+# Define the region of interest (ROI) for the parking spot
+x, y, w, h = 800, 500, 550, 580  # Adjust these coordinates for your setup
+# Buffer for the grayscale ROI, reused on every recognition
+roi_gray = np.empty((h, w), dtype=np.uint8)
+# Buffer for the 32x32 thumbnail of the grayscale ROI used for motion detection
+motion_gray = np.empty((32, 32), dtype=np.uint8)
+# Buffer for the ROI resized to the 300x300 detector input
+detector_input = np.empty((300, 300, 3), dtype=np.uint8)
+
+# Mean absolute change of the ROI thumbnail (0-255) below which the detector is not run again
+motion_threshold = 4
+# Number of recognitions in a row that may reuse the last detections. Every reused result counts in
+# the history, so this bounds how much weight a single (possibly wrong) detection gets in the vote
+detection_max_reuse = 4
+
+# Classes that count as a car in the parking spot
+car_trigger_classes = np.array([4, 7, 9, 15, 20], dtype=np.int32)  # anything goes, depending on lighting and reflections
+
+# Number of recognitions kept in history and the thresholds for a car arriving/leaving
+history_size = 120
+car_arrived_threshold = 80
+car_left_threshold = 40
+
+# Define the start and end times of the monitored period
+start_time = dtime(8, 0)  # 08:00
+end_time = dtime(20, 0)   # 20:00
+
 # Parking spot status: False means no car, True means car present
 car_present = False
 # Time tracking for when the car left
 car_left_time = None
 # Track the last time recognition was run
-last_recognition_time = time.time()
-# Add a buffer to store detection results
-car_history = []
+last_recognition_time = time.monotonic()
+# Thumbnail of the grayscale ROI the detector last ran on
+detection_gray = None
+# Number of times the detector has run, and recognitions since it last ran
+detection_count = 0
+detection_reuse_count = 0
+# Add a buffer to store detection results, the oldest result drops out once it's full
+car_history = collections.deque(maxlen=history_size)
+# Number of recognitions in history that detected a car
+car_count = 0
 
 while True:
     if cap is None:  # If the stream is not connected, try to reconnect
@@ -394,91 +671,96 @@ while True:
         time.sleep(1)
         continue
 
-    ret, frame = cap.read()
-    
-    # If frame is not grabbed, reconnect to the stream
-    if not ret:
-        log.warning("Failed to grab frame. Reconnecting to the stream...")
-        cap.release()  # Release the previous connection
-        cap = connect_to_rtsp_stream(rtsp_url)  # Reconnect to the stream
-        time.sleep(5)  # Add a small delay to avoid tight looping
-        continue  # Skip this iteration and try again
-
-    # Get the current time
-    current_time = time.time()
+    # Get the current time (monotonic, so clock adjustments don't disturb the interval)
+    current_time = time.monotonic()
 
     # Only run recognition once every minute (or based on the interval)
     if current_time - last_recognition_time >= recognition_interval:
+        # Get the latest frame; the reader keeps grabbing in the background
+        ret, frame = cap.read()
+
+        # If frame is not grabbed, reconnect to the stream
+        if not ret:
+            log.warning("Failed to grab frame. Reconnecting to the stream...")
+            cap.release()  # Release the previous connection
+            cap = connect_to_rtsp_stream(rtsp_url)  # Reconnect to the stream
+            time.sleep(5)  # Add a small delay to avoid tight looping
+            continue  # Skip this iteration and try again
+
         # Update the last recognition time
         last_recognition_time = current_time
 
-        # Define the region of interest (ROI) for the parking spot
-        x, y, w, h = 800, 500, 550, 580  # Adjust these coordinates for your setup
+        # Crop the region of interest (ROI) for the parking spot
         roi = frame[y:y+h, x:x+w]
 
-        # Prepare the frame for object detection
-        blob = cv2.dnn.blobFromImage(roi, 0.007843, (300, 300), 127.5)
-        net.setInput(blob)
-        detections = net.forward()
-
-        debug_image = draw_debug_image(roi, detections)
-
-        car_detected = False
-
-        # Process detections
-        for i in range(detections.shape[2]):
-            confidence = detections[0, 0, i, 2]
-            if confidence > 0.4:  # Confidence threshold for detection
-                class_id = int(detections[0, 0, i, 1])
-                if class_id in [4, 7, 9, 15, 20]: # anything goes, depending on lighting and reflections
-                    car_detected = True
-                    break
-
-        timestamp_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Fingerprint the ROI from its grayscale version
+        roi_gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY, dst=roi_gray)
+        frame_hash = compute_frame_hash(roi_gray)
+
+        # Only run the detector if the ROI changed noticeably since it last ran,
+        # otherwise reuse its detections. Comparing thumbnails averages out sensor noise
+        motion_gray = cv2.resize(roi_gray, (32, 32), dst=motion_gray, interpolation=cv2.INTER_AREA)
+        if (detection_gray is not None and detection_reuse_count < detection_max_reuse
+                and cv2.norm(motion_gray, detection_gray, cv2.NORM_L1) / motion_gray.size < motion_threshold):
+            log.debug('No motion in ROI, reusing the last detections')
+            detection_reuse_count += 1
+        else:
+            # Prepare the frame for object detection
+            detector_input = cv2.resize(roi, (300, 300), dst=detector_input)
+            blob = cv2.dnn.blobFromImage(detector_input, 0.007843, (300, 300), 127.5)
+            net.setInput(blob)
+            detections = net.forward()
+            detection_gray = motion_gray.copy()
+            detection_count += 1
+            detection_reuse_count = 0
+
+        # Keep only the confident detections, as rows of [_, class id, confidence, box]
+        confident_detections = detections[0, 0][detections[0, 0, :, 2] > 0.4]  # Confidence threshold for detection
+
+        # The annotated ROI is only used by the SPI display and the debug image output
+        debug_image = None
+        if not is_windows or args.image:
+            debug_image = draw_debug_image(roi, confident_detections)
+
+        # Process detections: is any confident detection one of the trigger classes?
+        class_ids = confident_detections[:, 1].astype(np.int32)
+        car_detected = bool(np.isin(class_ids, car_trigger_classes).any())
+
+        # Get the current time once for this recognition
+        now = datetime.now()
 
         # Append result to detection history for averaging
+        # Keep the car count in step with the result that drops out of the full history
+        if len(car_history) == history_size:
+            car_count -= car_history[0]
         car_history.append(car_detected)
+        car_count += car_detected
 
-        # Keep only the last 10 frames in history
-        if len(car_history) > 120:
-            car_history.pop(0)
-
-        # Get the current time
-        current_time = datetime.now().time()
-        # Define the start and end times
-        start_time = dtime(8, 0)  # 08:00
-        end_time = dtime(20, 0)   # 20:00
-
-        if start_time <= current_time <= end_time:
+        if start_time <= now.time() <= end_time:
             # Decide if the car is present based on the majority of recent detections
-            if sum(car_history) >= 80:  # More than 80 out of the last 120 frames detect a car
+            if car_count >= car_arrived_threshold:  # More than 80 out of the last 120 frames detect a car
                 if not car_present:
-                    log_car_activity(timestamp_str, "Car arrived back")
+                    log_car_activity(now, "Car arrived back")
                     if is_windows:
                         update_icon_state(icon, "taken") # Update taskbar icon to red (taken)
                 car_present = True
-            elif sum(car_history) <= 40: # Less than 40 out of the last 120 frames detect no car
+            elif car_count <= car_left_threshold: # Less than 40 out of the last 120 frames detect no car
                 if car_present:
-                    log_car_activity(timestamp_str, "Car left the parking spot")
+                    log_car_activity(now, "Car left the parking spot")
                     if is_windows:
                         update_icon_state(icon, "free") # Update taskbar icon to green (free)
                 car_present = False
         
-        draw_statusbar(car_history, debug_image)
+        draw_statusbar(car_history, debug_image, frame_hash, detection_count)
 
         # Save the debug image
         if args.image:
-            debug_image_path = f"debug/debug_output_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.jpg"
-            # if cv2.imwrite(debug_image_path, roi):
-            try:
-                debug_image.save(debug_image_path)
-            except IOError:
-                log.warning(f"Couldn't save debug image: {debug_image_path}")   
-            else:
-                log.debug(f"Debug image saved: {debug_image_path}")
-
-
-    # Sleep for a short time (optional) to reduce CPU load
-    time.sleep(0.1)
+            debug_image_path = f"debug/debug_output_{now:%Y-%m-%d_%H-%M-%S}.jpg"
+            debug_image_submit(debug_image, debug_image_path)
+
+
+    # Sleep until the next recognition is due to reduce CPU load. The interval counts from the
+    # start of the last recognition, so the time spent on it doesn't add up to a drift
+    time.sleep(max(0, last_recognition_time + recognition_interval - time.monotonic()))
 
 cap.release()
\ No newline at end of file